@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
 import math
+import functools
+import osqp
 import risk_mod as rm
 
+from  numba import njit, prange
+from  scipy import sparse
+from  scipy.linalg import cho_solve
 from  scipy.optimize import minimize
 
 """
@@ -15,8 +20,10 @@ def portfolio_return(weights, returns):
     """
     Computes the return on a portfolio from constituent returns and weights
     weights are a numpy array or Nx1 matrix and returns are a numpy array or Nx1 matrix
+    pandas inputs are read as plain arrays, so no label alignment happens per call
     """
-    return weights.T @ returns
+    weights = np.asarray(weights)
+    return np.dot(weights.T, np.asarray(returns))
 
 
 #=============================== Portfolio Volatility =========================================
@@ -25,23 +32,45 @@ def portfolio_vol(weights, covmat):
     """
     Computes the vol of a portfolio from a covariance matrix and constituent weights
     weights are a numpy array or N x 1 maxtrix and covmat is an N x N matrix
+    pandas inputs are read as plain arrays, so no label alignment happens per call
     """
-    return (weights.T @ covmat @ weights)**0.5
+    weights = np.asarray(weights)
+    return np.dot(weights.T, np.dot(np.asarray(covmat), weights))**0.5
+
+
+#=============================== Portfolio Volatility from a Cholesky factor =========================================
+
+def _cholesky(cov):
+    """
+    Returns the lower-triangular Cholesky factor L of a covariance matrix, C = LL'
+    a tiny ridge keeps the factorization defined for positive semi-definite matrices
+    """
+    cov = np.asarray(cov, dtype=float)
+    return np.linalg.cholesky(cov + 1e-12*np.eye(cov.shape[0]))
+
+
+def _vol_from_L(weights, L):
+    """
+    Computes the vol of a portfolio as ||L'w|| given the Cholesky factor L of the covariance matrix
+    """
+    y = L.T @ weights
+    return np.dot(y, y)**0.5
 
 #=============================== Efficient Frontier for TWO assets =========================================
 
-def plot_ef(n_points, er, cov, style=".-"):
+def plot_ef_2asset(n_points, er, cov, style=".-"):
     """
     Plots the 2-asset efficient frontier
     """
-    if er.shape[0] != 2 or er.shape[0] != 2:
+    if er.shape[0] != 2 or cov.shape[0] != 2:
         
-        raise ValueError("plot_ef can only plot 2-asset frontiers")
+        raise ValueError("plot_ef_2asset can only plot 2-asset frontiers")
         
-    weights = [np.array([w, 1-w]) for w in np.linspace(0, 1, n_points)]
+    w_1     = np.linspace(0, 1, n_points)
+    weights = np.column_stack([w_1, 1-w_1])
     
-    rets = [portfolio_return(w, er) for w in weights]
-    vols = [portfolio_vol(w, cov) for w in weights]
+    rets = weights @ np.asarray(er)
+    vols = np.sqrt(np.einsum('ij,jk,ik->i', weights, np.asarray(cov), weights))
     
     ef   = pd.DataFrame({"Return":    rets, 
                          "Risk": vols})
@@ -56,31 +85,90 @@ def minimize_vol(target_return, er, cov):
     """
     Returns the optimal weights that achieve the target return
     given a set of expected returns (er) and a covariance matrix (cov)
+    the problem is a QP, solved by OSQP on the cached problem from frontier_qp
     """
+    problem, l, u = frontier_qp(er, cov)
     
-    n          = er.shape[0]         # number of assets
-    init_guess = np.repeat(1/n, n)   # an equally weighted portfolio of assets as the initial guess
+    l[0] = u[0] = target_return
+    problem.update(l = l, u = u)
+    return _solve_qp(problem)
+
+
+#=============================== Mean-Variance QP (cached) =========================================
+
+_qp_cache = {}
+
+def frontier_qp(er, cov):
+    """
+    Returns the mean-variance problem min w'Cw s.t. er'w = target, sum(w) = 1, 0 <= w_i <= 1
+    as a set-up OSQP solver, with constraints stacked as l <= [er'; 1'; I] w <= u
+    the KKT matrix is factorized once per (er, cov) and cached, so a frontier sweep
+    only updates the first row of l and u
+    """
+    er  = np.asarray(er,  dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    key = (er.tobytes(), cov.tobytes())
     
-    bounds = ((0.0, 1.0),) * n       # For all n assets, 0 <= w_i <= 1.0
+    if key not in _qp_cache:
+        if len(_qp_cache) >= 16:
+            _qp_cache.pop(next(iter(_qp_cache)))   # drop the oldest problem
+        
+        n = er.shape[0]
+        
+        # minimizing the variance (rather than the vol) keeps it a pure QP with the same solution
+        P = sparse.triu(2*cov, format = 'csc')
+        q = np.zeros(n)
+        A = sparse.vstack([er, np.ones(n), sparse.eye(n)], format = 'csc')
+        l = np.concatenate([[0.0, 1.0], np.zeros(n)])
+        u = np.concatenate([[0.0, 1.0], np.ones(n)])
+        
+        problem = osqp.OSQP()
+        problem.setup(P, q, A, l, u, warm_starting = True, polishing = True,
+                      eps_abs = 1e-8, eps_rel = 1e-8, verbose = False)
+        _qp_cache[key] = (problem, l, u)
+        
+    return _qp_cache[key]
+
+
+def _solve_qp(problem):
+    """
+    Solves a set-up OSQP problem and returns the weights,
+    raising a ValueError if OSQP did not reach a solution (e.g. an infeasible target return)
+    """
+    result = problem.solve()
+    if result.info.status not in ("solved", "solved inaccurate"):
+        raise ValueError(f"The QP could not be solved: OSQP status '{result.info.status}'")
+    return result.x
+
+
+#=============================== Two-Fund Separation =========================================
+
+def two_fund_weights(target_rs, er, cov):
+    """
+    Closed-form frontier weights when the 0 <= w_i <= 1 bounds are not binding
+    every frontier portfolio is an affine combination of inv(C)er and inv(C)1
+    returns a matrix of weight where each row is associated with a target return
+    """
+    er   = np.asarray(er,  dtype=float)
+    cov  = np.asarray(cov, dtype=float)
+    ones = np.ones(er.shape[0])
     
-    # construct the constraints
-    weights_sum_to_1 = {'type': 'eq',
-                        'fun' : lambda weights: np.sum(weights) - 1
-    }
+    # one factorization, then two triangular solves for inv(C)er and inv(C)1
+    L = (_cholesky(cov), True)
+    a = cho_solve(L, er)
+    b = cho_solve(L, ones)
     
-    return_is_target = {'type': 'eq',
-                        'args': (er,),
-                        'fun' : lambda weights, er: target_return - portfolio_return(weights, er)
-    }
+    A = er @ b
+    B = er @ a
+    C = ones @ b
+    D = B*C - A*A
     
-    weights = minimize(portfolio_vol, init_guess,
-                       args        = (cov,),
-                       method      = 'SLSQP',
-                       options     = {'disp': False},
-                       constraints = (weights_sum_to_1, return_is_target),
-                       bounds      = bounds
-                      )
-    return weights.x
+    target_rs = np.asarray(target_rs, dtype=float)
+    
+    # D ~ 0 when er is (nearly) proportional to ones: the two funds coincide and there is no closed form
+    if D <= 1e-10*B*C:
+        return np.full((target_rs.shape[0], er.shape[0]), np.nan)
+    return (np.outer(C*target_rs - A, a) + np.outer(B - A*target_rs, b))/D
 
 
 #=============================== Get Optimal Weights for all potential Retunrs =========================================
@@ -89,29 +177,69 @@ def optimal_weights(n_points, er, cov):
     """
     creates a linear space of returns as target retruns
     computes optimal weights that deliver that return
-    returns a matrix of weight where each row is associated with a target return
+    returns a (n_points x n) matrix of weight where each row is associated with a target return
     """
     target_rs = np.linspace(er.min(), er.max(), n_points)
-    weights   = [minimize_vol(target_return, er, cov) for target_return in target_rs]
+    
+    # where no bound is binding, the closed form is the answer;
+    # only the remaining target returns (or rows the closed form got wrong) go through the QP
+    weights  = two_fund_weights(target_rs, er, cov)
+    tol      = 1e-8*max(1.0, np.abs(er).max())
+    feasible = (np.isfinite(weights).all(axis=1) &
+                ((weights >= 0) & (weights <= 1)).all(axis=1) &
+                (np.abs(weights.sum(axis=1) - 1) <= 1e-8) &
+                (np.abs(weights @ np.asarray(er, dtype=float) - target_rs) <= tol))
+    binding  = ~feasible
+    if not binding.any():
+        return weights
+    
+    problem, l, u = frontier_qp(er, cov)
+    for i in np.flatnonzero(binding):
+        l[0] = u[0] = target_rs[i]
+        problem.update(l = l, u = u)
+        weights[i] = _solve_qp(problem)
     
     return weights
 
-#=============================== Efficient Frontier for Multiple assets =========================================
+#=============================== Efficient Frontier (cached) =========================================
+
+def compute_frontier(n_points, er, cov):
+    """
+    Returns the weights, returns and vols of n_points portfolios on the efficient frontier
+    without plotting anything, e.g. for parameter sweeps
+    results are memoized on the values of er and cov, so repeated plots do not re-solve the frontier
+    """
+    er  = np.asarray(er,  dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    return _frontier(n_points, tuple(er), tuple(cov.flat))
 
 
-def plot_ef(n_points, er, cov, style = '.-'):
+@functools.lru_cache(maxsize = 16)
+def _frontier(n_points, er, cov):
     """
-    Plots the multi-asset efficient frontier
+    Cached body of compute_frontier(); er and cov come in as tuples so that they are hashable
     """
-    weights = optimal_weights(n_points, er, cov) 
-    
-    rets    = [portfolio_return(w, er) for w in weights]
-    vols    = [portfolio_vol(w, cov)   for w in weights]
+    er  = np.array(er)
+    cov = np.array(cov).reshape(er.shape[0], er.shape[0])
     
-    ef      = pd.DataFrame({"Returns"   : rets,         
-                            "Volatility": vols})
+    weights = optimal_weights(n_points, er, cov)
+    rets    = weights @ er
+    vols    = np.sqrt(np.einsum('ij,jk,ik->i', weights, cov, weights))
     
-    return ef.plot.line(x = "Volatility", y = "Returns", style = style)
+    # the arrays are shared by every caller of the cache
+    for x in (weights, rets, vols):
+        x.setflags(write = False)
+    return weights, rets, vols
+
+
+#=============================== Efficient Frontier for Multiple assets =========================================
+
+
+def plot_ef(n_points, er, cov, style = '.-', ax = None):
+    """
+    Plots the multi-asset efficient frontier
+    """
+    return plot_ef_all(n_points, er, cov, style = style, ax = ax, ef_style = {})
 
 
 
@@ -130,20 +258,32 @@ def msr(riskfree_rate, er, cov):
     
     # construct the constraints
     weights_sum_to_1 = {'type': 'eq',
-                        'fun' : lambda weights: np.sum(weights) - 1
+                        'fun' : lambda weights: np.sum(weights) - 1,
+                        'jac' : lambda weights: np.ones_like(weights)
     }
     
-    def neg_sharpe(weights, riskfree_rate, er, cov):
+    def neg_sharpe(weights, riskfree_rate, er, L):
         """
         Returns the negative of the sharpe ratio
         of the given portfolio
         """
         r   = portfolio_return(weights, er)
-        vol = portfolio_vol(weights, cov)
+        vol = _vol_from_L(weights, L)
         return -(r - riskfree_rate)/vol
     
+    def neg_sharpe_jac(weights, riskfree_rate, er, L):
+        """
+        Returns the gradient of the negative sharpe ratio: -(er/vol - (r - rf)LL'w/vol^3)
+        """
+        y     = L.T @ weights
+        cov_w = L @ y
+        vol   = np.sqrt(y @ y)
+        r     = er @ weights
+        return -(er/vol - (r - riskfree_rate)*cov_w/vol**3)
+    
     weights = minimize(neg_sharpe, init_guess,
-                       args        = (riskfree_rate, er, cov),
+                       args        = (riskfree_rate, np.asarray(er), _cholesky(cov)),
+                       jac         = neg_sharpe_jac,
                        method      = 'SLSQP',
                        options     = {'disp': False},
                        constraints = (weights_sum_to_1,),
@@ -155,74 +295,24 @@ def msr(riskfree_rate, er, cov):
 #=============================== Efficient Frontier for Multiple assets with CML=========================================
 
 
-def plot_ef_cml(n_points, er, cov, show_cml = False, style = '.-', riskfree_rate = 0):
+def plot_ef_cml(n_points, er, cov, show_cml = False, style = '.-', riskfree_rate = 0, ax = None):
     """
     Plots the multi-asset efficient frontier
     """
-    weights = optimal_weights(n_points, er, cov) 
-    
-    rets    = [portfolio_return(w, er) for w in weights]
-    vols    = [portfolio_vol(w, cov)   for w in weights]
-    
-    ef      = pd.DataFrame({"Returns"   : rets,         
-                            "Volatility": vols})
-    
-    ax = ef.plot.line(x = "Volatility", y = "Returns", style = style)
-
-    if show_cml:
-        ax.set_xlim(left = 0)
-        
-        # get MSR
-        w_msr   = msr(riskfree_rate, er, cov)
-        r_msr   = portfolio_return(w_msr, er)
-        vol_msr = portfolio_vol(w_msr, cov)
-        
-        # display CML
-        cml_x = [0, vol_msr]
-        cml_y = [riskfree_rate, r_msr]
-        ax.plot(cml_x, cml_y, color='green', marker='o', linestyle='dashed', linewidth=2, markersize=12)
-        
-        return ax
+    return plot_ef_all(n_points, er, cov, show_cml = show_cml, style = style, riskfree_rate = riskfree_rate, ax = ax,
+                       ef_style  = {},
+                       cml_style = dict(color='green', marker='o', linestyle='dashed', linewidth=2, markersize=12))
     
 #=============================== Efficient Frontier for Multiple assets with CML, EW =========================================
 
-def plot_ef_cml_ew(n_points, er, cov, show_cml = False, show_ew = False, style = '.-', riskfree_rate = 0):
+def plot_ef_cml_ew(n_points, er, cov, show_cml = False, show_ew = False, style = '.-', riskfree_rate = 0, ax = None):
     """
     Plots the multi-asset efficient frontier
     """
-    weights = optimal_weights(n_points, er, cov) 
-    
-    rets    = [portfolio_return(w, er) for w in weights]
-    vols    = [portfolio_vol(w, cov)   for w in weights]
-    
-    ef      = pd.DataFrame({"Returns"   : rets,         
-                            "Volatility": vols})
-    
-    ax = ef.plot.line(x = "Volatility", y = "Returns", style = style)
-    
-    if show_ew:
-        n      = er.shape[0]
-        w_ew   = np.repeat(1/n, n)
-        r_ew   = portfolio_return(w_ew, er)
-        vol_ew = portfolio_vol(w_ew, cov)
-        
-        # display EW
-        ax.plot([vol_ew], [r_ew], color='goldenrod', marker='o', markersize=10)
-        
-    if show_cml:
-        ax.set_xlim(left = 0)
-        
-        # get MSR
-        w_msr   = msr(riskfree_rate, er, cov)
-        r_msr   = portfolio_return(w_msr, er)
-        vol_msr = portfolio_vol(w_msr, cov)
-        
-        # display CML
-        cml_x = [0, vol_msr]
-        cml_y = [riskfree_rate, r_msr]
-        ax.plot(cml_x, cml_y, color='indianred', marker='o', linestyle='dashed', linewidth=2, markersize=12)
-        
-        return ax
+    return plot_ef_all(n_points, er, cov, show_cml = show_cml, show_ew = show_ew, style = style, riskfree_rate = riskfree_rate, ax = ax,
+                       ef_style  = {},
+                       ew_style  = dict(color='goldenrod', marker='o', markersize=10),
+                       cml_style = dict(color='indianred', marker='o', linestyle='dashed', linewidth=2, markersize=12))
 
 #=============================== Global Minimum Volatility portfolio =========================================
 
@@ -231,26 +321,38 @@ def gmv(cov):
     Returns the weights of the Global Minimum Volatility portfolio
     given a covariance matrix
     """
-    n = cov.shape[0]
-    return msr(0, np.repeat(1, n), cov)
+    n    = cov.shape[0]
+    ones = np.ones(n)
     
-#=============================== Efficient Frontier for Multiple assets with CML, EW, GMV =========================================
+    # closed form inv(C)1/(1'inv(C)1), valid when no 0 <= w_i <= 1 bound binds
+    weights = cho_solve((_cholesky(cov), True), ones)
+    weights = weights/weights.sum()
+    if ((weights >= 0) & (weights <= 1)).all():
+        return weights
+    
+    # otherwise solve the bounded QP, with the target-return row left unconstrained
+    problem, l, u = frontier_qp(ones, cov)
+    l[0], u[0] = -np.inf, np.inf
+    problem.update(l = l, u = u)
+    return _solve_qp(problem)
+    
+#=============================== Rendering of the Efficient Frontier =========================================
 
-def plot_ef_cml_ew_gmv(n_points, er, cov, show_cml = False, show_ew = False, show_gmv = False, style = '.-', riskfree_rate = 0):
+def _render_frontier(er, cov, rets, vols, show_cml, show_ew, show_gmv, style, riskfree_rate, ax,
+                     ef_style, ew_style, gmv_style, cml_style):
     """
-    Plots the multi-asset efficient frontier
+    Draws a computed efficient frontier and, optionally, the EW, GMV and MSR/CML markers
+    onto ax, or onto a new figure if ax is None
+    the *_style dicts are handed to matplotlib for the corresponding line
     """
-    weights = optimal_weights(n_points, er, cov) 
-    
-    rets    = [portfolio_return(w, er) for w in weights]
-    vols    = [portfolio_vol(w, cov)   for w in weights]
-    
-    ef      = pd.DataFrame({"Returns"   : rets,         
-                            "Volatility": vols})
-    
+    if ax is not None:
+        # the figure already exists, so its size is not ours to set
+        ef_style = {k: v for k, v in ef_style.items() if k != 'figsize'}
+        
+    ef = pd.DataFrame({"Returns"   : rets,         
+                       "Volatility": vols})
     
-    ax = ef.plot.line(x = "Volatility", y = "Returns", style = style, title = "Optimal Portfolio Theory in practice",
-                      label = 'Efficient Frontier', color = 'blue',  markersize = 7, figsize = (10,5))
+    ax = ef.plot.line(x = "Volatility", y = "Returns", style = style, ax = ax, **ef_style)
     
     if show_ew:
         n      = er.shape[0]
@@ -259,7 +361,7 @@ def plot_ef_cml_ew_gmv(n_points, er, cov, show_cml = False, show_ew = False, sho
         vol_ew = portfolio_vol(w_ew, cov)
         
         # display EW
-        ax.plot([vol_ew], [r_ew], color='green', marker='o', markersize = 7, label = 'Eq. Weight')
+        ax.plot([vol_ew], [r_ew], **ew_style)
 
     if show_gmv:
         w_gmv   = gmv(cov)
@@ -267,8 +369,7 @@ def plot_ef_cml_ew_gmv(n_points, er, cov, show_cml = False, show_ew = False, sho
         vol_gmv = portfolio_vol(w_gmv, cov)
         
         # display GMV
-        ax.plot([vol_gmv], [r_gmv], color='black', marker='o', markersize = 7, label = 'GMV')
-        
+        ax.plot([vol_gmv], [r_gmv], **gmv_style)
         
     if show_cml:
         ax.set_xlim(left = 0)
@@ -281,70 +382,180 @@ def plot_ef_cml_ew_gmv(n_points, er, cov, show_cml = False, show_ew = False, sho
         # display CML
         cml_x = [0, vol_msr]
         cml_y = [riskfree_rate, r_msr]
-        ax.plot(cml_x, cml_y, color='indianred', marker='o', linestyle='dashed', linewidth = 2, markersize = 7, label = 'CML')
+        ax.plot(cml_x, cml_y, **cml_style)
+        
+    if show_ew or show_gmv or show_cml:
         ax.legend()
         
-        return ax
+    return ax
 
 
-#=============================== Constant Proportion Portfolio Insurance =========================================
+#=============================== Efficient Frontier for Multiple assets with CML, EW, GMV =========================================
 
-def run_cppi(risky_r, safe_r=None, m=3, start=1000, floor=0.8, riskfree_rate=0.03, drawdown = None):
+def plot_ef_all(n_points, er, cov, show_cml = False, show_ew = False, show_gmv = False, style = '.-', riskfree_rate = 0, ax = None,
+                ef_style  = dict(title = "Optimal Portfolio Theory in practice", label = 'Efficient Frontier',
+                                 color = 'blue', markersize = 7, figsize = (10,5)),
+                ew_style  = dict(color='green', marker='o', markersize = 7, label = 'Eq. Weight'),
+                gmv_style = dict(color='black', marker='o', markersize = 7, label = 'GMV'),
+                cml_style = dict(color='indianred', marker='o', linestyle='dashed', linewidth = 2, markersize = 7, label = 'CML')):
     """
-    Run a backtest of the CPPI strategy, given a set of returns for the risky asset
-    Returns a dictionary containing: Asset Value History, Risk Budget History, Risky Weight History
+    Plots the multi-asset efficient frontier, with the EW, GMV and CML (MSR) portfolios on request
+    pass an existing matplotlib ax to draw into it instead of creating a new figure
+    the frontier is shared with the other plot_ef* functions through the compute_frontier() cache
     """
+    er  = np.asarray(er,  dtype=float)
+    cov = np.asarray(cov, dtype=float)
     
-    # parameters
-    dates         = risky_r.index
-    n_steps       = len(dates)
-    account_value = start
+    weights, rets, vols = compute_frontier(n_points, er, cov)
+    
+    return _render_frontier(er, cov, rets, vols, show_cml, show_ew, show_gmv, style, riskfree_rate, ax,
+                            ef_style, ew_style, gmv_style, cml_style)
+
+
+def plot_ef_cml_ew_gmv(n_points, er, cov, show_cml = False, show_ew = False, show_gmv = False, style = '.-', riskfree_rate = 0, ax = None):
+    """
+    Plots the multi-asset efficient frontier
+    """
+    return plot_ef_all(n_points, er, cov, show_cml = show_cml, show_ew = show_ew, show_gmv = show_gmv,
+                       style = style, riskfree_rate = riskfree_rate, ax = ax)
+
+
+#=============================== CPPI kernel (compiled) =========================================
+
+@njit(fastmath = True, cache = True)
+def _cppi_core(risky_arr, safe_arr, m, start, floor, drawdown, cap):
+    """
+    Runs the CPPI recursion over every column (scenario) of risky_arr and safe_arr
+    drawdown and cap may be None, in which case numba compiles those branches away
+    returns the account value, risky weight and cushion histories as numpy arrays
+    """
+    n_steps, n_cols = risky_arr.shape
+    
+    account_history = np.empty((n_steps, n_cols))
+    risky_w_history = np.empty((n_steps, n_cols))
+    cushion_history = np.empty((n_steps, n_cols))
+    
+    account_value = np.full(n_cols, start*1.0)
+    floor_value   = np.full(n_cols, start*floor)
+    peak          = np.full(n_cols, start*1.0)
+    
+    if cap is not None:
+        cap_value = cap*start
+        # mid-point between floor and cap where the cap becomes the binding constraint;
+        # it only moves over time when the floor is dynamic
+        cap_switch = np.full(n_cols, (start*floor + cap_value)/2)
+    
+    for step in range(n_steps):
+        for j in range(n_cols):
+            # dynamic floor
+            if drawdown is not None:
+                peak[j]        = max(peak[j], account_value[j])
+                floor_value[j] = peak[j]*(1-drawdown)
+                if cap is not None:
+                    cap_switch[j] = (floor_value[j] + cap_value)/2
+            
+            # cushion against the floor, or against the static cap once it is closer
+            if cap is not None:
+                if account_value[j] >= cap_switch[j]:
+                    cushion = (cap_value - account_value[j])/account_value[j]
+                else:
+                    cushion = (account_value[j] - floor_value[j])/account_value[j]
+            else:
+                cushion = (account_value[j] - floor_value[j])/account_value[j]
+                
+            risky_w = max(min(m*cushion, 1.0), 0.0)
+            
+            risky_alloc = account_value[j]*risky_w
+            safe_alloc  = account_value[j]*(1-risky_w)
+            
+            # recompute the new account value
+            account_value[j] = risky_alloc*(1+risky_arr[step, j]) + safe_alloc*(1+safe_arr[step, j])
+            
+            # save the histories
+            cushion_history[step, j] = cushion
+            risky_w_history[step, j] = risky_w
+            account_history[step, j] = account_value[j]
+            
+    return account_history, risky_w_history, cushion_history
+
+
+@njit(fastmath = True, cache = True)
+def _cppi_simple_core(risky_arr, safe_arr, m, start, floor):
+    """
+    Fast path of _cppi_core for a static floor and no cap:
+    a_{t+1} = a_t*(1 + w_t*r_risky + (1-w_t)*r_safe) with w_t = clip(m*(1 - floor/a_t), 0, 1)
+    """
+    n_steps, n_cols = risky_arr.shape
+    
+    account_history = np.empty((n_steps, n_cols))
+    risky_w_history = np.empty((n_steps, n_cols))
+    cushion_history = np.empty((n_steps, n_cols))
+    
+    account_value = np.full(n_cols, start*1.0)
     floor_value   = start*floor
-    peak          = start
     
+    for step in range(n_steps):
+        for j in range(n_cols):
+            cushion = (account_value[j] - floor_value)/account_value[j]
+            risky_w = min(max(m*cushion, 0.0), 1.0)
+            
+            account_value[j] = account_value[j]*(risky_w*(1+risky_arr[step, j]) + (1-risky_w)*(1+safe_arr[step, j]))
+            
+            cushion_history[step, j] = cushion
+            risky_w_history[step, j] = risky_w
+            account_history[step, j] = account_value[j]
+            
+    return account_history, risky_w_history, cushion_history
+
+
+#=============================== CPPI inputs =========================================
+
+def _cppi_inputs(risky_r, safe_r, riskfree_rate):
+    """
+    Normalizes the CPPI inputs once, up-front
+    returns risky_r and safe_r as DataFrames, plus their values as float arrays of the same shape
+    """
     if isinstance(risky_r, pd.Series): 
-        risky_r = pd.DataFrame(risky_r, columns=["R"])
+        risky_r = risky_r.to_frame("R")
 
     if safe_r is None:
-        safe_r = pd.DataFrame().reindex_like(risky_r)
-        safe_r.values[:] = riskfree_rate/12 
+        safe_r = pd.DataFrame(riskfree_rate/12, index = risky_r.index, columns = risky_r.columns)
+    elif isinstance(safe_r, pd.Series):
+        safe_r = safe_r.to_frame()
         
-    # DataFrames for saving intermediate values
-    account_history = pd.DataFrame().reindex_like(risky_r)
-    risky_w_history = pd.DataFrame().reindex_like(risky_r)
-    cushion_history = pd.DataFrame().reindex_like(risky_r)
+    risky_vals = np.asarray(risky_r.to_numpy(), dtype = float)
+    safe_vals  = np.asarray(safe_r.to_numpy(),  dtype = float)
     
-    for step in range(n_steps):
-        # dynamic floor
-        if drawdown is not None:
-            peak = np.maximum(peak, account_value)
-            floor_value = peak*(1-drawdown)
-            
-        cushion = (account_value - floor_value)/account_value
-        risky_w = m*cushion
-        risky_w = np.minimum(risky_w, 1)
-        risky_w = np.maximum(risky_w, 0)
-        safe_w  = 1-risky_w
-        
-        
-        risky_alloc = account_value*risky_w
-        safe_alloc = account_value*safe_w
-        
-        # recompute the new account value 
-        account_value = risky_alloc*(1+risky_r.iloc[step]) + safe_alloc*(1+safe_r.iloc[step])
-        
-        # save the histories 
-        cushion_history.iloc[step] = cushion
-        risky_w_history.iloc[step] = risky_w
-        account_history.iloc[step] = account_value
+    # a single safe column applies to every risky column
+    safe_vals  = np.ascontiguousarray(np.broadcast_to(safe_vals, risky_vals.shape))
+    
+    return risky_r, safe_r, risky_vals, safe_vals
+
+
+#=============================== Constant Proportion Portfolio Insurance =========================================
+
+def run_cppi(risky_r, safe_r=None, m=3, start=1000, floor=0.8, riskfree_rate=0.03, drawdown = None):
+    """
+    Run a backtest of the CPPI strategy, given a set of returns for the risky asset
+    Returns a dictionary containing: Asset Value History, Risk Budget History, Risky Weight History
+    """
+    risky_r, safe_r, risky_vals, safe_vals = _cppi_inputs(risky_r, safe_r, riskfree_rate)
+    
+    # parameters
+    dates         = risky_r.index
+    
+    if drawdown is None:
+        account_history, risky_w_history, cushion_history = _cppi_simple_core(risky_vals, safe_vals, m, start, floor)
+    else:
+        account_history, risky_w_history, cushion_history = _cppi_core(risky_vals, safe_vals, m, start, floor, drawdown, None)
         
-        risky_wealth = start*(1+risky_r).cumprod()
+    risky_wealth = pd.DataFrame(start*np.cumprod(1+risky_vals, axis=0), index = dates, columns = risky_r.columns)
         
     result = {
-              "Wealth"           : account_history,
+              "Wealth"           : pd.DataFrame(account_history, index = dates, columns = risky_r.columns),
               "Risky Wealth"     : risky_wealth, 
-              "Risk Budget"      : cushion_history,
-              "Risky Allocation" : risky_w_history,
+              "Risk Budget"      : pd.DataFrame(cushion_history, index = dates, columns = risky_r.columns),
+              "Risky Allocation" : pd.DataFrame(risky_w_history, index = dates, columns = risky_r.columns),
               "multiplier"       : m,
               "start"            : start,
               "floor"            : floor,
@@ -362,85 +573,73 @@ def run_cppi_cap(risky_r, safe_r=None, m=3, start=1000, floor=0.8, riskfree_rate
     Run a backtest of the CPPI strategy, given a set of returns for the risky asset
     Returns a dictionary containing: Asset Value History, Risk Budget History, Risky Weight History
     """
-    cushion = risky_r.iloc[0].copy()
-    cushion.values[:] = 0
-    account_value = risky_r.iloc[0].copy()
-    account_value.values[:] = start
-    cap_value     = risky_r.iloc[0].copy()
-    cap_value.values[:] = cap*start
-
+    risky_r, safe_r, risky_vals, safe_vals = _cppi_inputs(risky_r, safe_r, riskfree_rate)
+    
     # parameters
     dates         = risky_r.index
-    n_steps       = len(dates)
-    floor_value   = start*floor
-    peak          = start
-    
-    
-        
-    if isinstance(risky_r, pd.Series): 
-        risky_r = pd.DataFrame(risky_r, columns=["R"])
-
-    if safe_r is None:
-        safe_r = pd.DataFrame().reindex_like(risky_r)
-        safe_r.values[:] = riskfree_rate/12 
-        
-    # DataFrames for saving intermediate values
-    account_history = pd.DataFrame().reindex_like(risky_r)
-    risky_w_history = pd.DataFrame().reindex_like(risky_r)
-    cushion_history = pd.DataFrame().reindex_like(risky_r)
-    
     
-    for step in range(n_steps):
-        
-        # dynamic floor            
-        if drawdown is not None:
-            peak = np.maximum(peak, account_value)
-            floor_value = peak*(1-drawdown)
-            
-        cushion = (account_value - floor_value)/account_value
-
-        # static cap
-        if cap is not None:
-            cushion[account_value >= (floor_value + cap_value)/2] = (cap_value - account_value)/account_value
-              
-        risky_w = m*cushion
-        risky_w = np.minimum(risky_w, 1)
-        risky_w = np.maximum(risky_w, 0)
-        safe_w  = 1-risky_w
-                
-        risky_alloc = account_value*risky_w
-        safe_alloc = account_value*safe_w                
-        
+    if drawdown is None and cap is None:
+        account_history, risky_w_history, cushion_history = _cppi_simple_core(risky_vals, safe_vals, m, start, floor)
+    else:
+        account_history, risky_w_history, cushion_history = _cppi_core(risky_vals, safe_vals, m, start, floor, drawdown, cap)
         
-        
-        
-        # recompute the new account value 
-        account_value = risky_alloc*(1+risky_r.iloc[step]) + safe_alloc*(1+safe_r.iloc[step])
-        
-        # save the histories 
-        cushion_history.iloc[step] = cushion
-        risky_w_history.iloc[step] = risky_w
-        account_history.iloc[step] = account_value
-        
-        risky_wealth = start*(1+risky_r).cumprod()
-        result = {
-            "Wealth":           account_history,
-            "Risky Wealth":     risky_wealth, 
-            "Risk Budget":      cushion_history,
-            "Risky Allocation": risky_w_history,
-            "multiplier":       m,
-            "start":            start,
-            "floor":            floor,
-            "risky_r":          risky_r,
-            "safe_r":           safe_r
+    risky_wealth = pd.DataFrame(start*np.cumprod(1+risky_vals, axis=0), index = dates, columns = risky_r.columns)
+    result = {
+        "Wealth":           pd.DataFrame(account_history, index = dates, columns = risky_r.columns),
+        "Risky Wealth":     risky_wealth, 
+        "Risk Budget":      pd.DataFrame(cushion_history, index = dates, columns = risky_r.columns),
+        "Risky Allocation": pd.DataFrame(risky_w_history, index = dates, columns = risky_r.columns),
+        "multiplier":       m,
+        "start":            start,
+        "floor":            floor,
+        "risky_r":          risky_r,
+        "safe_r":           safe_r
     }
     return result
 
 
 
+#=============================== CIR kernels (compiled) =========================================
+
+@njit(parallel = True, fastmath = True, cache = True)
+def _cir_core(num_steps, n_scenarios, a, b, sigma, dt, r_0, shock, rates):
+    """
+    Fills rates with CIR paths of the instantaneous rate
+    time is sequential, so each step runs over all scenarios in parallel
+    (a row of rates is contiguous, which keeps the inner loop vectorizable)
+    """
+    for s in prange(n_scenarios):
+        rates[0, s] = r_0
+        
+    for step in range(1, num_steps):
+        for s in prange(n_scenarios):
+            r_t = rates[step-1, s]
+            d_r = a*(b-r_t)*dt + sigma*math.sqrt(r_t)*shock[step, s]
+            rates[step, s] = max(r_t + d_r, 0.0)
+
+
+@njit(parallel = True, fastmath = True, cache = True)
+def _zcb_cir_core(num_steps, n_scenarios, a, b, sigma, dt, r_0, shock, A, B, rates, prices):
+    """
+    Fills rates with CIR paths of the instantaneous rate and prices with
+    the zero-coupon bond price A*exp(-B*r) along each path
+    A and B only depend on time-to-maturity, so they come in precomputed per step
+    """
+    for s in prange(n_scenarios):
+        rates[0, s]  = r_0
+        prices[0, s] = A[0]*math.exp(-B[0]*r_0)
+        
+    for step in range(1, num_steps):
+        for s in prange(n_scenarios):
+            r_t = rates[step-1, s]
+            d_r = a*(b-r_t)*dt + sigma*math.sqrt(r_t)*shock[step, s]
+            rates[step, s]  = max(r_t + d_r, 0.0)
+            prices[step, s] = A[step]*math.exp(-B[step]*rates[step, s])
+
+
 #=============================== Cox-Ingersoll-Ross (CIR) Model =========================================
 
-def cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_per_year = 12, r_0 = None):
+def cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_per_year = 12, r_0 = None, seed = None, dtype = np.float64):
     """
     Inputs
     n_years        : planning horizon in years
@@ -450,6 +649,9 @@ def cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_p
     sigma          : volatility of short term rate
     steps_per_year : frequency 
     r_0            : starting annualized rate
+    seed           : seed for a fresh random generator, for reproducible paths
+    dtype          : float type of the simulation; np.float32 halves memory traffic for large n_scenarios
+                     (its rounding is far below the O(sqrt(dt)) discretization error)
     
     output
     a dataframe of simulated paths for the "annualized" rate according to the CIR model
@@ -462,22 +664,24 @@ def cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_p
     
     dt        = 1/steps_per_year
     num_steps = int(n_years*steps_per_year) + 1
+    dtype     = np.dtype(dtype).type
     
-    shock = np.random.normal(0, scale = np.sqrt(dt), size = (num_steps, n_scenarios))
+    rng   = rm.get_rng(seed)
+    shock = np.empty((num_steps, n_scenarios), dtype = dtype)
+    rng.standard_normal(dtype = dtype, out = shock)
+    shock *= math.sqrt(dt)
     rates = np.empty_like(shock)
     
-    rates[0] = r_0
-    for step in range(1, num_steps):
-        r_t         = rates[step-1]
-        d_r_t       = a*(b-r_t)*dt + sigma*np.sqrt(r_t)*shock[step]
-        rates[step] = abs(r_t + d_r_t)  
+    # scalars in the same dtype, so a float32 run is not promoted back to float64 in the kernel
+    a, b, sigma, dt, r_0 = (dtype(x) for x in (a, b, sigma, dt, r_0))
+    _cir_core(num_steps, n_scenarios, a, b, sigma, dt, r_0, shock, rates)
         
     return pd.DataFrame(data = rm.inst_to_ann(rates), index = range(num_steps))
 
 
 #=============================== Price of Zero-Coupon Bond based on CIR Model =========================================
 
-def zcb_cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_per_year = 12, r_0 = None):
+def zcb_cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, steps_per_year = 12, r_0 = None, seed = None, dtype = np.float64):
     """
     Inputs
     n_years        : planning horizon in years
@@ -487,6 +691,9 @@ def zcb_cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, ste
     sigma          : volatility of short term rate
     steps_per_year : frequency 
     r_0            : starting annualized rate
+    seed           : seed for a fresh random generator, for reproducible paths
+    dtype          : float type of the simulation; np.float32 halves memory traffic for large n_scenarios
+                     (its rounding is far below the O(sqrt(dt)) discretization error)
     
     outputs
     rates : simulated paths for the "annualized" rate according to the CIR model
@@ -501,42 +708,26 @@ def zcb_cir(n_years = 10, n_scenarios = 1, a = 0.05, b = 0.03, sigma = 0.05, ste
     
     dt        = 1/steps_per_year
     num_steps = int(n_years*steps_per_year) + 1
-    
-    shock    = np.random.normal(0, scale = np.sqrt(dt), size = (num_steps, n_scenarios))
-    rates    = np.empty_like(shock)
-    rates[0] = r_0
-    prices   = np.empty_like(shock) # simulated prices
-
-    
-    
-    h = math.sqrt(a**2 + 2*sigma**2)
-    
-    def price_cir(ttm, r):
-        """
-        Inputs
-        ttm: time-to-maturity (T-t)
-        r  : short-term interest rate at time t
-        
-        Output
-        price of a zero-coupon bond given ttm and r
-        """
-        A = ((2*h*math.exp((h+a)*ttm/2))/(2*h+(h+a)*(math.exp(h*ttm)-1)))**(2*a*b/sigma**2)
-        B = (2*(math.exp(h*ttm)-1))/(2*h + (h+a)*(math.exp(h*ttm)-1))
-        P = A*np.exp(-B*r)
-        
-        return P
-
-    
-    # initial prices
-    prices[0] = price_cir(n_years, r_0)
-    
-    
-    for step in range(1, num_steps):
-        r_t   = rates[step-1]
-        d_r_t = a*(b-r_t)*dt + sigma*np.sqrt(r_t)*shock[step]
-        
-        rates[step]  = abs(r_t + d_r_t)
-        prices[step] = price_cir(n_years-step*dt, rates[step])
+    dtype     = np.dtype(dtype).type
+    
+    rng    = rm.get_rng(seed)
+    shock  = np.empty((num_steps, n_scenarios), dtype = dtype)
+    rng.standard_normal(dtype = dtype, out = shock)
+    shock *= math.sqrt(dt)
+    rates  = np.empty_like(shock)
+    prices = np.empty_like(shock) # simulated prices
+    
+    # the price is A(ttm)*exp(-B(ttm)*r); A and B are known up-front for every step
+    h   = math.sqrt(a**2 + 2*sigma**2)
+    ttm = n_years - np.arange(num_steps)*dt
+    e_h = np.exp(h*ttm)
+    A   = ((2*h*np.exp((h+a)*ttm/2))/(2*h + (h+a)*(e_h-1)))**(2*a*b/sigma**2)
+    B   = (2*(e_h-1))/(2*h + (h+a)*(e_h-1))
+    
+    # scalars and tables in the same dtype, so a float32 run is not promoted back to float64 in the kernel
+    A, B = A.astype(dtype), B.astype(dtype)
+    a, b, sigma, dt, r_0 = (dtype(x) for x in (a, b, sigma, dt, r_0))
+    _zcb_cir_core(num_steps, n_scenarios, a, b, sigma, dt, r_0, shock, A, B, rates, prices)
 
     rates  = pd.DataFrame(data = rm.inst_to_ann(rates), index = range(num_steps))
     prices = pd.DataFrame(data = prices, index = range(num_steps))
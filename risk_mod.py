@@ -1,9 +1,23 @@
 import pandas as pd
 import numpy as np
 import math
+import re
+import functools
 
+from  numba import njit, prange
 from  scipy.optimize import minimize
 from scipy.stats import norm
+
+# the one PCG64 generator behind every simulation here and in Portfolio_mod (gbm, cir, zcb_cir)
+_RNG = np.random.default_rng()
+
+
+def get_rng(seed = None):
+    """
+    returns the shared generator, or a fresh one seeded with seed for reproducible draws
+    """
+    return _RNG if seed is None else np.random.default_rng(seed)
+
 #=============================== Compounding Returns =========================================
 
 def compound(r):
@@ -13,15 +27,53 @@ def compound(r):
     return np.expm1(np.log1p(r).sum())
 
 
+def compound_fast(r, _buf=None):
+    """
+    compound() on plain arrays: the log1p goes into a reusable buffer instead of a new temporary
+    pass the same _buf (an array shaped like r) on every call inside a Monte Carlo loop;
+    returns a float for 1-D input, an array (one value per column) for 2-D input
+    """
+    arr = np.asarray(r, dtype = np.float64)
+    if _buf is None or _buf.shape != arr.shape or _buf.dtype != arr.dtype:
+        _buf = np.empty_like(arr)
+    np.log1p(arr, out = _buf)
+    return np.expm1(_buf.sum(axis=0))[()]
+
+
 #=============================== Number of Periods in a year =========================================
 
+# periods per year of each base pandas frequency code: the number of stamps a full year of that
+# frequency holds, i.e. what counting one year of the index gives (365 calendar days, 261 weekdays);
+# custom business days ("C") depend on the holiday calendar, so they are counted off the index instead
+_PERIODS_PER_YEAR = {"D": 365, "B": 261, "W": 52,
+                     "SM": 24, "SME": 24, "SMS": 24,
+                     "M": 12, "ME": 12, "MS": 12, "BM": 12, "BME": 12, "BMS": 12,
+                     "Q": 4, "QE": 4, "QS": 4, "BQ": 4, "BQE": 4, "BQS": 4,
+                     "A": 1, "AS": 1, "BA": 1, "BAS": 1, "Y": 1, "YE": 1, "YS": 1, "BY": 1, "BYE": 1, "BYS": 1}
+
+
 def periods_per_year(df):
     """
     returns periods_per_year for a dataframe
     """
     #  the index must be a datetime object! 
-    # df.index.year.unique().values[1] chooses the second year, which hopefully is a complete year
+    # read it off the index frequency (set, or inferred from the first few stamps) when there is one
+    freq = getattr(df.index, "freqstr", None)
+    if freq is None:
+        try:
+            freq = pd.infer_freq(df.index)
+        except (TypeError, ValueError):
+            freq = None
+    if freq is not None:
+        match = re.match(r"(\d*)([A-Z]+)", freq.split("-")[0])
+        if match and match.group(2) in _PERIODS_PER_YEAR:
+            n, k = _PERIODS_PER_YEAR[match.group(2)], int(match.group(1) or 1)
+            # a multiple k that divides the year fits exactly n/k stamps; otherwise a year holds
+            # floor(n/k) or ceil(n/k) of them depending on where the stamps fall, so count them below
+            if n % k == 0:
+                return n//k
     
+    # df.index.year.unique().values[1] chooses the second year, which hopefully is a complete year
     return df.iloc[df.index.year == df.index.year.unique().values[1], 0].count()
 
 
@@ -32,9 +84,15 @@ def annualize_rets(r, periods_per_year):
     """
     Annualizes a set of returns
     """
-    compound_ret = (1+r).prod()
-    n_periods = r.shape[0]
-    return compound_ret**(periods_per_year/n_periods)-1
+    # sum of log returns instead of a product: one reduction for all columns, no overflow on long series;
+    # missing returns are skipped and each column is annualized over its own number of observations
+    arr = r.to_numpy(dtype = np.float64) if isinstance(r, (pd.Series, pd.DataFrame)) else np.asarray(r, dtype = np.float64)
+    n_periods = np.count_nonzero(~np.isnan(arr), axis=0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):   # an all-NaN column comes out as NaN
+        ann_r = np.expm1(np.nansum(np.log1p(arr), axis=0)*(periods_per_year/n_periods))
+    if isinstance(r, pd.DataFrame):
+        return pd.Series(ann_r, index = r.columns)
+    return ann_r
 
 
 #=============================== Annualize Volatility =========================================
@@ -62,6 +120,13 @@ def sharpe_ratio(r, riskfree_rate, periods_per_year):
     return ann_ex_ret/ann_vol
 
 
+def sharpe_from_stats(ann_ret, ann_vol, riskfree_rate):
+    """
+    Sharpe ratio from an already annualized return and volatility (scalars, arrays or Series)
+    """
+    return (ann_ret - riskfree_rate)/ann_vol
+
+
 #=============================== DRAWDOWNS =========================================
 
 def drawdown(returns_series: pd.Series, intitial_wealth = 100):
@@ -84,6 +149,73 @@ def drawdown(returns_series: pd.Series, intitial_wealth = 100):
     
     return output
 
+#=============================== Max Drawdown =========================================
+
+def max_drawdown(r):
+    """
+    returns the maximum drawdown (a negative number) of a set of returns
+    a float for a single series, an array with one value per column otherwise;
+    use drawdown() when the wealth index and the peaks are needed too
+    """
+    a       = np.asarray(r, dtype = np.float64)
+    missing = np.isnan(a)
+    # a missing return leaves the wealth flat, which can't create a new peak or trough (same as pandas skipping it)
+    w  = np.cumprod(1.0 + np.where(missing, 0.0, a), axis=0)
+    dd = (w/np.maximum.accumulate(w, axis=0) - 1.0).min(axis=0)
+    return np.where(missing.all(axis=0), np.nan, dd)[()]
+
+#=============================== Central Moments (compiled) ========================================
+
+@njit(cache = True)
+def _moments(arr):
+    """
+    mean, population variance, skewness and kurtosis of every column of a 2-D array;
+    one pass for the means, one fused pass for the 2nd/3rd/4th central moments, no temporaries
+    NaNs are skipped, so each column uses its own number of observations (like the pandas reductions)
+    """
+    n, c = arr.shape
+    cnt = np.zeros(c)
+    mu  = np.zeros(c)
+    m2  = np.zeros(c)
+    m3  = np.zeros(c)
+    m4  = np.zeros(c)
+    for i in range(n):
+        for j in range(c):
+            x = arr[i, j]
+            if not np.isnan(x):
+                cnt[j] += 1
+                mu[j]  += x
+    mu /= cnt
+    for i in range(n):
+        for j in range(c):
+            x = arr[i, j]
+            if not np.isnan(x):
+                d      = x - mu[j]
+                d2     = d*d
+                m2[j] += d2
+                m3[j] += d2*d
+                m4[j] += d2*d2
+    m2 /= cnt
+    return mu, m2, m3/cnt/m2**1.5, m4/cnt/m2**2
+
+
+def _central_moments(r):
+    """
+    runs _moments on a Series / DataFrame / array and gives back (mean, var, skew, kurt)
+    shaped like the pandas reductions would be: floats for 1-D input, Series for a DataFrame
+    """
+    if isinstance(r, (pd.Series, pd.DataFrame)):
+        arr = r.to_numpy(dtype = np.float64)
+    else:
+        arr = np.asarray(r, dtype = np.float64)
+    stats = _moments(np.ascontiguousarray(arr.reshape(arr.shape[0], -1)))
+    if arr.ndim == 1:
+        return tuple(float(x[0]) for x in stats)
+    if isinstance(r, pd.DataFrame):
+        return tuple(pd.Series(x, index = r.columns) for x in stats)
+    return stats
+
+
 #=============================== Skewness ========================================
 
 def myskewness(r):
@@ -92,11 +224,8 @@ def myskewness(r):
     Computes the skewness of the supplied Series or DataFrame
     Returns a float or a Series
     """
-    demeaned_r = r - r.mean()
-    # use the population standard deviation, so set dof=0
-    sigma_r = r.std(ddof=0)
-    exp = (demeaned_r**3).mean()
-    return exp/sigma_r**3
+    # population moments (ddof=0)
+    return _central_moments(r)[2]
 
 #=============================== Kurtosis =========================================
 def mykurtosis(r):
@@ -105,11 +234,8 @@ def mykurtosis(r):
     Computes the kurtosis of the supplied Series or DataFrame
     Returns a float or a Series
     """
-    demeaned_r = r - r.mean()
-    # use the population standard deviation, so set dof=0
-    sigma_r = r.std(ddof=0)
-    exp = (demeaned_r**4).mean()
-    return exp/sigma_r**4
+    # population moments (ddof=0)
+    return _central_moments(r)[3]
 
 #=============================== SEMIDEVIATION =========================================
 
@@ -119,8 +245,16 @@ def semideviation(r):
     output: Returns the semideviation aka negative semideviation of r
     
     """
-    is_negative = r < 0
-    return r[is_negative].std(ddof=0)
+    # masked sums instead of materialising r[r < 0]; population std (ddof=0) of the negative returns
+    arr   = r.to_numpy(dtype = np.float64) if isinstance(r, (pd.Series, pd.DataFrame)) else np.asarray(r, dtype = np.float64)
+    mask  = arr < 0
+    count = mask.sum(axis=0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):   # no negative returns comes out as NaN
+        mean  = np.where(mask, arr, 0.0).sum(axis=0)/count
+        semid = np.sqrt(np.where(mask, (arr - mean)**2, 0.0).sum(axis=0)/count)
+    if isinstance(r, pd.DataFrame):
+        return pd.Series(semid, index = r.columns)
+    return semid
 
 
 #=============================== Historical VaR =========================================
@@ -130,7 +264,8 @@ def var_historic(r, level=5):
     Returns the historic Value at Risk at a specified level 
     """
     if isinstance(r, pd.DataFrame):
-        return r.aggregate(var_historic, level=level)
+        # one percentile call down the rows of every column
+        return pd.Series(-np.percentile(r.to_numpy(dtype = np.float64), level, axis=0), index = r.columns)
     elif isinstance(r, pd.Series):
         return -np.percentile(r, level)
     else:
@@ -139,19 +274,68 @@ def var_historic(r, level=5):
 
 #=============================== Historical CVaR =========================================
 
+def _cvar_tail_mean(arr, level):
+    """
+    mean of the returns at or below the historic VaR cut-off, down the rows of a NaN-free array
+    """
+    if arr.shape[0] == 0:
+        return np.full(arr.shape[1:], np.nan)
+    # the k-th worst return is the historic VaR cut-off (same rank np.percentile lands on);
+    # a partial sort finds it in O(n) for all columns at once, ties at the cut-off are kept
+    k      = int(level/100*(arr.shape[0] - 1)) + 1
+    cutoff = np.partition(arr, k-1, axis=0)[k-1]
+    tail   = arr <= cutoff
+    return np.where(tail, arr, 0.0).sum(axis=0)/tail.sum(axis=0)
+
+
 def cvar_historic(r, level=5):
     """
     Returns the historic CVaR given a level that determines VaR.  
     """
-    if isinstance(r, pd.DataFrame):
-        return r.aggregate(cvar_historic, level=level)
-    elif isinstance(r, pd.Series):
-        is_lower = r<= -var_historic(r, level = level)
-        return -r[is_lower].mean()
+    if isinstance(r, (pd.DataFrame, pd.Series)):
+        arr = r.to_numpy(dtype = np.float64)
+        if np.isnan(arr).any():
+            # columns with missing values: each column over its own observations, so k follows its length
+            cols      = arr.reshape(arr.shape[0], -1).T
+            tail_mean = np.array([_cvar_tail_mean(c[~np.isnan(c)], level) for c in cols])
+            tail_mean = tail_mean if arr.ndim == 2 else tail_mean[0]
+        else:
+            tail_mean = _cvar_tail_mean(arr, level)
+        if isinstance(r, pd.DataFrame):
+            return pd.Series(-tail_mean, index = r.columns)
+        return -tail_mean
     else:
         raise TypeError("Expected the input to be a Series or DataFrame")  
         
         
+#=============================== Z-scores =========================================
+
+@functools.lru_cache(maxsize=32)
+def _z_of(level):
+    """
+    Gaussian z-score of a level given in percent, cached per level
+    """
+    return float(norm.ppf(level/100))
+
+
+def _z_score(level):
+    """
+    Gaussian z-score(s) of a level in percent: cached for a scalar level, vectorized for an array of levels
+    """
+    return _z_of(level) if np.ndim(level) == 0 else norm.ppf(np.asarray(level)/100)
+
+
+def _cornish_fisher_z(z, s, k):
+    """
+    Cornish-Fisher adjusted z-score for skewness s and kurtosis k (scalars or arrays)
+    """
+    return (z +
+                (z**2 - 1)*s/6 +
+                (z**3 -3*z)*(k-3)/24 -
+                (2*z**3 - 5*z)*(s**2)/36
+            )
+
+
 #=============================== Gaussian VaR =========================================
 
 def var_gaussian(r, level=5):
@@ -159,7 +343,7 @@ def var_gaussian(r, level=5):
     Returns the Parametric Gauusian VaR of a Series or DataFrame
     """
     # compute the Z score assuming it was Gaussian
-    z = norm.ppf(level/100)
+    z = _z_score(level)
     return -(r.mean() + z*r.std(ddof=0))
 
 
@@ -175,17 +359,13 @@ def var_parametric(r, level=5, modified=False):
     """
     # compute the Gaussian Z score 
     
-    z = norm.ppf(level/100)
+    z = _z_score(level)
     
     if modified:
         
-        s = myskewness(r)
-        k = mykurtosis(r)
-        z = (z +
-                (z**2 - 1)*s/6 +
-                (z**3 -3*z)*(k-3)/24 -
-                (2*z**3 - 5*z)*(s**2)/36
-            )
+        # skewness and kurtosis from a single moments pass
+        _, _, s, k = _central_moments(r)
+        z = _cornish_fisher_z(z, s, k)
         
     return -(r.mean() + z*r.std(ddof=0))
 
@@ -196,14 +376,25 @@ def summary_stats(r, freq = 12, riskfree_rate = 0.03, rn = 3):
     Return a DataFrame that contains aggregated summary stats for the returns in the columns of r
     """
     
-    ann_r      = r.aggregate(annualize_rets, periods_per_year = freq)
-    ann_vol    = r.aggregate(annualize_vol, periods_per_year = freq)
-    skew       = r.aggregate(myskewness)
-    kurt       = r.aggregate(mykurtosis)
-    cf_var5    = r.aggregate(var_parametric, modified=True)
-    hist_cvar5 = r.aggregate(cvar_historic)
-    ann_sr     = r.aggregate(sharpe_ratio, riskfree_rate = riskfree_rate, periods_per_year = freq)
-    dd         = r.aggregate(lambda r: drawdown(r).Drawdown.min())    
+    # every stat comes from the same float array, reduced down the rows for all columns at once;
+    # missing returns are skipped, so each column uses its own number of observations
+    arr = r.to_numpy(dtype = np.float64)
+    n   = np.count_nonzero(~np.isnan(arr), axis=0)
+    
+    # central moments (population, ddof=0, as in myskewness / mykurtosis)
+    mu, var, skew, kurt = _moments(np.ascontiguousarray(arr))
+    
+    ann_r   = annualize_rets(arr, freq)
+    ann_vol = np.sqrt(var*n/(n - 1))*freq**0.5
+    
+    # Cornish-Fisher VaR at 5%
+    cf_var5 = -(mu + _cornish_fisher_z(_z_of(5), skew, kurt)*np.sqrt(var))
+    
+    hist_cvar5 = cvar_historic(r).to_numpy()
+    
+    ann_sr = sharpe_from_stats(ann_r, ann_vol, riskfree_rate)
+    
+    dd = max_drawdown(arr)
     
     
     return pd.DataFrame({
@@ -213,13 +404,13 @@ def summary_stats(r, freq = 12, riskfree_rate = 0.03, rn = 3):
         "Kurtosis": np.round(kurt, rn),
         "Cornish-Fisher VaR (5%)": np.round(100*cf_var5, rn),
         "Historic VaR (5%)":  np.round(100*hist_cvar5, rn),
-        "Sharpe Ratio": np.round(ann_r, rn),
+        "Sharpe Ratio": np.round(ann_sr, rn),
         "Max Drawdown": np.round(100*dd, rn),
-    })
+    }, index = r.columns)
 
 
 #=============================== General Browninan Motion =========================================
-def gbm(n_years = 10, n_scenarios = 1000, mu = 0.07, sigma = 0.15, steps_per_year = 12, x_0 = 100.0, prices = True):
+def gbm(n_years = 10, n_scenarios = 1000, mu = 0.07, sigma = 0.15, steps_per_year = 12, x_0 = 100.0, prices = True, seed = None, dtype = np.float32):
     """
     Evolution of Geometric Brownian Motion trajectories, such as for Stock Prices
     
@@ -229,6 +420,9 @@ def gbm(n_years = 10, n_scenarios = 1000, mu = 0.07, sigma = 0.15, steps_per_yea
     sigma          : Annualized Volatility
     steps_per_year : granularity of the simulation
     x_0            : initial value of asset
+    seed           : seed for a fresh random generator, for reproducible paths
+    dtype          : float type of the draws; float32 halves memory traffic, and quantiles of the
+                     paths are dominated by Monte Carlo noise rather than float32 rounding
     
     returns: a numpy array of n_paths columns and n_years*steps_per_year rows
     """
@@ -244,12 +438,26 @@ def gbm(n_years = 10, n_scenarios = 1000, mu = 0.07, sigma = 0.15, steps_per_yea
     # rets_plus_1 = np.random.normal(loc=(1 + mu*dt), scale=(sigma*np.sqrt(dt)), size=(n_steps, n_scenarios))
 
     # a more accurate way is to compund returns over the prtiod of dt, which means  
-    rets_plus_1 = np.random.normal(loc=(1+mu)**dt, scale=(sigma*np.sqrt(dt)), size=(n_steps, n_scenarios))
+    # (drawn as standard normals in the requested dtype and scaled in place)
+    dtype       = np.dtype(dtype).type
+    rng         = get_rng(seed)
+    rets_plus_1 = rng.standard_normal((n_steps, n_scenarios), dtype = dtype)
+    rets_plus_1 *= dtype(sigma*math.sqrt(dt))
+    rets_plus_1 += dtype((1+mu)**dt)
     
     #   for illustrative purposes, start from the starting price    
     rets_plus_1[0] = 1
-    price = x_0*pd.DataFrame(rets_plus_1).cumprod() if prices else rets_plus_1-1
-    return price
+    if not prices:
+        return rets_plus_1-1
+    
+    # compound in log space on the same buffer: log -> cumsum -> exp, no pandas cumprod.
+    # a normal draw can (very rarely) be <= 0, i.e. a loss beyond -100%; floor it at a tiny positive value
+    np.maximum(rets_plus_1, np.finfo(rets_plus_1.dtype).tiny, out = rets_plus_1)
+    np.log(rets_plus_1, out = rets_plus_1)
+    np.cumsum(rets_plus_1, axis = 0, out = rets_plus_1)
+    np.exp(rets_plus_1, out = rets_plus_1)
+    rets_plus_1 *= x_0
+    return pd.DataFrame(rets_plus_1)
 
 #=============================== Discount Factor =========================================
 
@@ -275,6 +483,22 @@ def pv(l, r):
     
     return (discounts*l).sum()
 
+#=============================== Present Value for many rates =========================================
+
+def pv_vec(cash_flows, times, rates):
+    """
+    Present value of one set of cash flows under each of several interest rates
+    cash_flows : values paid at each of times
+    times      : payment times, in the same frequency as the rates
+    rates      : array of interest rates (e.g. one per scenario)
+    
+    output: an array with one present value per rate
+    """
+    cash_flows = np.asarray(cash_flows, dtype = np.float64)
+    times      = np.asarray(times, dtype = np.float64)
+    rates      = np.atleast_1d(np.asarray(rates, dtype = np.float64))
+    return ((1.0 + rates[None, :])**(-times[:, None])*cash_flows[:, None]).sum(axis=0)
+
 #=============================== Funding Ratio-1 =========================================
 
 def funding_ratio(assets, liabilities, r):
@@ -285,8 +509,10 @@ def funding_ratio(assets, liabilities, r):
         interest rate
     
     returns
-        the funding ratio based on the interest rate 
+        the funding ratio based on the interest rate (one per rate if r is array-like)
     """
+    if np.ndim(r):
+        return assets/pv_vec(liabilities, liabilities.index, r)
     return assets/pv(liabilities, r)
 
 #=============================== Funding Ratio-2 =========================================
@@ -300,8 +526,10 @@ def funding_ratio2(assets, liabilities, r):
         interest rate
     
     returns
-        the funding ratio based on the interest rate
+        the funding ratio based on the interest rate (one per rate if r is array-like)
     """
+    if np.ndim(r):
+        return pv_vec(assets, assets.index, r)/pv_vec(liabilities, liabilities.index, r)
     return pv(assets, r)/pv(liabilities, r)
 
 #=============================== instantaneous-to-annual interest rate =========================================
@@ -341,29 +569,71 @@ def cf_construct(maturity = 10, principal = 100, coupon_rate = 0.03, coupons_per
     n_coupons  = round(maturity*coupons_per_year)
     coupon_pay = principal*coupon_rate/coupons_per_year
     pay_number = np.arange(1, n_coupons+1)
-    cash_flow  = pd.Series(data = coupon_pay, index = pay_number)
     
-    cash_flow.iloc[-1] = cash_flow.iloc[-1] + principal # add the principal to the last payment
+    # copy the cached schedule, so the Series can be modified without touching the cache
+    return pd.Series(data = _cf_array(n_coupons, coupon_pay, principal).copy(), index = pay_number)
+
+
+@functools.lru_cache(maxsize=1024)
+def _cf_array(n_coupons, coupon_pay, principal):
+    """
+    constant coupons with the principal added to the last payment, cached per schedule (read-only)
+    """
+    cash_flow = np.full(n_coupons, coupon_pay, dtype = np.float64)
+    cash_flow[-1] += principal
+    cash_flow.flags.writeable = False
     return cash_flow
 
 
+def cf_construct_np(maturity = 10, principal = 100, coupon_rate = 0.03, coupons_per_year = 12):
+    """
+    Same as cf_construct, but returns the cash flows as a (cached, read-only) numpy array,
+    payment k+1 at position k
+    """
+    return _cf_array(round(maturity*coupons_per_year), principal*coupon_rate/coupons_per_year, principal)
+
+
+#=============================== Price of a coupon bond from cash-flow tables =========================================
+
+
+def bond_price_np(rates_row, pay_times, cf_values, cpy):
+    """
+    Inputs
+        rates_row: annual discount rate(s), one price per rate
+        pay_times: payment times in years (e.g. k/cpy for payment k)
+        cf_values: cash flow paid at each of pay_times
+        cpy: compounding periods per year
+    
+    Returns 
+        an array of bond prices, one per rate in rates_row
+    """
+    # per-period rates and pay times in periods
+    return pv_vec(cf_values, np.asarray(pay_times)*cpy, np.asarray(rates_row)/cpy)
+
+
 #=============================== Price of a zero-coupon bond =========================================
 
 
-def bond_price(maturity = 10, principal = 100, coupon_rate = 0.03, coupons_per_year = 12, discount_rate = 0.03):
+def bond_price(maturity = 10, principal = 100, coupon_rate = 0.03, coupons_per_year = 12, discount_rate = 0.03, pay_times = None, cf_values = None):
     """
     Inputs
         maturity of the bond in years
         principal of the bond
         coupon_rate: interest paid on principle annually 
         coupons_per_year
-        discount_rate: in general, this is the yield curve
+        discount_rate: in general, this is the yield curve (a scalar or an array of rates)
+        pay_times, cf_values: optional precomputed payment times (years) and cash flows,
+                              to skip rebuilding the schedule when pricing the same bond repeatedly
     
     Returns 
-        price of bond 
+        price of bond (an array of prices if discount_rate is an array)
     """
-    cash_flow = cf_construct(maturity, principal, coupon_rate, coupons_per_year)
-    return pv(cash_flow, discount_rate/coupons_per_year)
+    if pay_times is None or cf_values is None:
+        cf_values = cf_construct_np(maturity, principal, coupon_rate, coupons_per_year)
+        pay_times = np.arange(1, cf_values.shape[0]+1)/coupons_per_year
+        
+    price = bond_price_np(discount_rate, pay_times, cf_values, coupons_per_year)
+    return price if np.ndim(discount_rate) else price[0]
 
 
 #=============================== Macaulay Duration of a Cash Flow =========================================
@@ -382,6 +652,26 @@ def macaulay_duration(cf, discount_rate):
 
     return (cf.index*disct_cf).sum()/disct_cf.sum()
 
+#=============================== Macaulay Duration for many rates =========================================
+
+
+def macaulay_duration_vec(cf_times, cf_values, r_vec):
+    """
+    Input
+        cf_times: payment times of the cash flow sequence
+        cf_values: cash flow paid at each of cf_times
+        r_vec: array of discount rates, matching the frequency of cf_times
+    
+    return
+        an array with the Macaulay Duration under each rate in r_vec
+    """
+    cf_times  = np.asarray(cf_times, dtype = np.float64)
+    cf_values = np.asarray(cf_values, dtype = np.float64)
+    r_vec     = np.atleast_1d(np.asarray(r_vec, dtype = np.float64))
+    disct_cf  = (1.0 + r_vec[None, :])**(-cf_times[:, None])*cf_values[:, None]
+    
+    return (cf_times[:, None]*disct_cf).sum(axis=0)/disct_cf.sum(axis=0)
+
 #=============================== Matching Duration Portfolio =========================================
 
 
@@ -394,13 +684,51 @@ def matching_weights(cf_1, cf_2, cf_l, discount_rate):
     
     Returns 
         weight of bond 1 to match the effective duration liabilities
+        (one weight per rate if discount_rate is array-like)
     """
-    d_1 = macaulay_duration(cf_1, discount_rate)
-    d_2 = macaulay_duration(cf_2, discount_rate)
-    d_l = macaulay_duration(cf_l, discount_rate)
+    if np.ndim(discount_rate):
+        d_1, d_2, d_l = (macaulay_duration_vec(cf.index, cf, discount_rate) for cf in (cf_1, cf_2, cf_l))
+    else:
+        d_1 = macaulay_duration(cf_1, discount_rate)
+        d_2 = macaulay_duration(cf_2, discount_rate)
+        d_l = macaulay_duration(cf_l, discount_rate)
     
     return (d_2 - d_l)/(d_2 - d_1)
 
+#=============================== Coupon-bond pricing kernel (compiled) =========================================
+
+@njit(parallel = True, fastmath = True, cache = True)
+def _bond_price_sim_kernel(rates, steps, maturity, principal, coupon_rate, coupons_per_year):
+    """
+    Prices a coupon-paying bond at every step (row) and scenario (column) of rates
+    steps holds the step number of each row; discount factors are built by repeated
+    multiplication, so there is no pow and no temporary array
+    """
+    n_steps, n_scenarios = rates.shape
+    out    = np.empty_like(rates)
+    coupon = principal*coupon_rate/coupons_per_year
+    
+    for i in range(n_steps):
+        # remaining life in payment periods (kept in periods so that maturity lands exactly on zero)
+        rem = maturity*coupons_per_year - steps[i]
+        
+        if rem <= 0:
+            for j in prange(n_scenarios):
+                out[i, j] = principal + coupon
+        else:
+            n_coupons = round(rem)
+            for j in prange(n_scenarios):
+                d     = 1/(1 + rates[i, j]/coupons_per_year)
+                disc  = 1.0
+                price = 0.0
+                for k in range(n_coupons):
+                    disc  *= d
+                    price += coupon*disc
+                out[i, j] = price + principal*disc
+                
+    return out
+
+
 #=============================== Simulate Price of a coupon-paying bond =========================================
 
 
@@ -416,17 +744,11 @@ def bond_price_sim(rates, maturity, principal, coupon_rate, coupons_per_year):
     output
     a dataframe of price of a coupon-bearing bond over each simulated path for short term rate
     """
-
-    bondp = pd.DataFrame().reindex_like(rates)
-
-    for i in bondp.index:
-        for j in bondp:
-            if maturity - i/coupons_per_year <= 0:
-                bondp.loc[i,j] = principal + principal*coupon_rate/coupons_per_year        
-            else:
-                bondp.loc[i,j] = bond_price(maturity - i/coupons_per_year, principal, coupon_rate, coupons_per_year, rates.loc[i,j])
+    bondp = _bond_price_sim_kernel(np.ascontiguousarray(rates.to_numpy(dtype = np.float64)),
+                                   rates.index.to_numpy(dtype = np.float64),
+                                   maturity, principal, coupon_rate, coupons_per_year)
     
-    return bondp
+    return pd.DataFrame(bondp, index = rates.index, columns = rates.columns)
 
 
 #=============================== Return of a coupon-paying bond =========================================
@@ -444,10 +766,13 @@ def bond_return(bondp, principal, coupon_rate, coupons_per_year):
     """
 
     coupon = principal*coupon_rate/coupons_per_year
-    bondr  = pd.DataFrame().reindex_like(bondp)
-
-    for i in range(1, len(bondp.index)):
-        for j in bondr:
-            bondr.loc[i,j] = (bondp.loc[i,j] + coupon)/bondp.loc[i-1,j] - 1 
-
-    return annualize_rets(bondr.dropna(), 12)
\ No newline at end of file
+    prices = bondp.to_numpy(dtype = np.float64)
+    
+    # (price today + coupon)/price yesterday - 1, for every step and path, written into one preallocated buffer
+    rets   = np.empty((prices.shape[0] - 1, prices.shape[1]))
+    np.add(prices[1:], coupon, out = rets)
+    np.divide(rets, prices[:-1], out = rets)
+    rets  -= 1
+    bondr  = pd.DataFrame(rets, index = bondp.index[1:], columns = bondp.columns, copy = False)
+
+    return annualize_rets(bondr, 12)
\ No newline at end of file